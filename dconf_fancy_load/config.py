@@ -13,15 +13,21 @@
 # limitations under the License.
 """Config file data structures and parsing functions."""
 
-import collections
-from collections.abc import Sequence
-import configparser
+from collections.abc import Iterator, Sequence
 import dataclasses
+import functools
 import os
 import pathlib
+from typing import Final
 
 import jinja2
 
+# Suffix of config file names.
+_INI_SUFFIX: Final = ".ini.jinja"
+
+# https://docs.gtk.org/glib/gvariant-text-format.html#booleans
+_BOOLS: Final[dict[str, bool]] = {"true": True, "false": False}
+
 
 @dataclasses.dataclass(kw_only=True)
 class Key:
@@ -49,69 +55,178 @@ class Dir:
     """
 
     reset: bool | None = None
-    subdirs: dict[str, "Dir"] = dataclasses.field(
-        default_factory=lambda: collections.defaultdict(Dir)
-    )
-    keys: dict[str, Key] = dataclasses.field(
-        default_factory=lambda: collections.defaultdict(Key)
-    )
+    subdirs: dict[str, "Dir"] = dataclasses.field(default_factory=dict)
+    keys: dict[str, Key] = dataclasses.field(default_factory=dict)
 
     def get_subdir(self, path: Sequence[str]) -> "Dir":
-        """Returns a subdir specified as relative path components."""
-        if not path:
-            return self
-        return self.subdirs[path[0]].get_subdir(path[1:])
+        """Returns a subdir specified as relative path components.
+
+        Missing subdirs are created.
+        """
+        dir_ = self
+        for name in path:
+            dir_ = dir_.subdirs.setdefault(name, Dir())
+        return dir_
 
 
 def _parse_bool(value: str, *, context: str) -> bool:
-    # https://docs.gtk.org/glib/gvariant-text-format.html#booleans
-    match value:
-        case "true":
-            return True
-        case "false":
-            return False
-        case _:
-            raise ValueError(f"{context}: {value!r} is not a boolean")
-
-
-def get(config_dir: pathlib.Path) -> Dir:
-    """Returns the root dir config from merging all config files."""
-    root = Dir()
-    jinja_env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(config_dir), autoescape=False
-    )
-    for path in sorted(config_dir.iterdir()):
-        if not path.name.endswith(".ini.jinja"):
+    try:
+        return _BOOLS[value]
+    except KeyError:
+        raise ValueError(f"{context}: {value!r} is not a boolean") from None
+
+
+def _iter_ini(text: str, *, source: str) -> Iterator[tuple[str, str, str]]:
+    """Parses an INI file.
+
+    The format matches configparser's with "=" as the only delimiter, "#" as
+    the only (full line) comment prefix, no interpolation, and case sensitive
+    keys: lines are split on "\n" only, text after the last "]" of a section
+    header is ignored, and multi-line values are continued on lines indented
+    more than the key. Unlike configparser, [DEFAULT] is an ordinary section,
+    and repeated sections or keys are not errors.
+
+    Args:
+        text: Contents of the file.
+        source: Name of the file, for error messages.
+
+    Yields:
+        (section, key, value) tuples in file order. Lines of multi-line values
+        are joined with spaces, since dconf values can't contain newlines.
+    """
+    section = None
+    # Section, key, and value lines of the option being parsed, if any.
+    option: tuple[str, str, list[str]] | None = None
+    indent_level = 0
+    for lineno, line in enumerate(text.split("\n"), start=1):
+        stripped = line.strip()
+        if not stripped:
+            if option is not None:
+                option[2].append("")
             continue
-        config = configparser.ConfigParser(
-            delimiters=("=",),
-            comment_prefixes=("#",),
-            interpolation=None,
-        )
-        config.optionxform = lambda optionstr: optionstr  # type: ignore[method-assign]
-        config.read_string(
-            jinja_env.get_template(path.name).render(env=os.environ),
-            source=str(path),
+        if stripped.startswith("#"):
+            continue
+        cur_indent_level = len(line) - len(line.lstrip())
+        if option is not None and cur_indent_level > indent_level:
+            option[2].append(stripped)
+            continue
+        if option is not None:
+            yield option[0], option[1], " ".join(option[2]).rstrip()
+            option = None
+        indent_level = cur_indent_level
+        if stripped.startswith("[") and "]" in stripped[2:]:
+            section = stripped[1 : stripped.rindex("]")]
+            continue
+        if section is None:
+            raise ValueError(f"{source}:{lineno}: missing section header")
+        raw_key, delimiter, value = stripped.partition("=")
+        key = raw_key.rstrip()
+        if not delimiter or not key:
+            raise ValueError(
+                f"{source}:{lineno}: {stripped!r} is not key=value"
+            )
+        option = (section, key, [value.lstrip()])
+    if option is not None:
+        yield option[0], option[1], " ".join(option[2]).rstrip()
+
+
+class _BestEffortBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache that treats errors reading or writing it as misses.
+
+    The cache is only an optimization, so a cache dir that can't be used
+    shouldn't stop templates from rendering.
+    """
+
+    def load_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            pass
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def _jinja_env(
+    config_dir: pathlib.Path,
+    cache_dir: pathlib.Path | None,
+) -> jinja2.Environment:
+    """Returns a jinja environment for the config dir.
+
+    The environment is cached so that its compiled templates can be reused by
+    later calls to get() with the same config dir.
+
+    Args:
+        config_dir: Directory to load templates from.
+        cache_dir: Directory to cache compiled templates in across runs, or None
+            to not cache them on disk. If the directory can't be created, the
+            templates aren't cached on disk.
+    """
+    bytecode_cache = None
+    if cache_dir is not None:
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            pass
+        else:
+            bytecode_cache = _BestEffortBytecodeCache(str(cache_dir))
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(config_dir),
+        autoescape=False,
+        bytecode_cache=bytecode_cache,
+        # Keep every template, no matter how many files are in the config dir.
+        cache_size=-1,
+    )
+
+
+def get(
+    config_dir: pathlib.Path,
+    *,
+    cache_dir: pathlib.Path | None = None,
+) -> Dir:
+    """Returns the root dir config from merging all config files.
+
+    Args:
+        config_dir: Directory with config files.
+        cache_dir: Directory to cache compiled templates in across runs, or None
+            to not cache them on disk.
+    """
+    root = Dir()
+    jinja_env = _jinja_env(config_dir, cache_dir)
+    # Snapshot the environment once instead of going through os.environ's
+    # encoding and decoding for every lookup in every template.
+    env = dict(os.environ)
+    with os.scandir(config_dir) as it:
+        entries = sorted(
+            (entry for entry in it if entry.name.endswith(_INI_SUFFIX)),
+            key=lambda entry: entry.name,
         )
-        for section in config.sections():
+    for entry in entries:
+        for section, raw_key, value in _iter_ini(
+            jinja_env.get_template(entry.name).render(env=env),
+            source=entry.path,
+        ):
             if section == "/":
                 dir_ = root
             else:
                 dir_ = root.get_subdir(section.split("/"))
-            for raw_key, value in config[section].items():
-                context = f"Section {section!r} key {raw_key!r}"
-                key_name, _, subkey = raw_key.partition("/")
-                if key_name:
-                    key = dir_.keys[key_name]
-                    if not subkey:
-                        key.value = value.replace("\n", " ")
-                    elif subkey == "reset":
-                        key.reset = _parse_bool(value, context=context)
-                    else:
-                        raise ValueError(f"{context}: unsupported option")
-                else:  # option applies to directory
-                    if subkey == "reset":
-                        dir_.reset = _parse_bool(value, context=context)
-                    else:
-                        raise ValueError(f"{context}: unsupported option")
+            context = f"Section {section!r} key {raw_key!r}"
+            key_name, _, subkey = raw_key.partition("/")
+            if key_name:
+                key = dir_.keys.setdefault(key_name, Key())
+                if not subkey:
+                    key.value = value
+                elif subkey == "reset":
+                    key.reset = _parse_bool(value, context=context)
+                else:
+                    raise ValueError(f"{context}: unsupported option")
+            else:  # option applies to directory
+                if subkey == "reset":
+                    dir_.reset = _parse_bool(value, context=context)
+                else:
+                    raise ValueError(f"{context}: unsupported option")
     return root
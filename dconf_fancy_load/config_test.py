@@ -13,9 +13,12 @@
 # limitations under the License.
 
 from collections.abc import Mapping
+import os
 import pathlib
 import textwrap
+from unittest import mock
 
+import jinja2
 import pytest
 
 from dconf_fancy_load import config
@@ -37,6 +40,9 @@ def test_dir_get_subdir() -> None:
         ({"foo.ini.jinja": "[/]\n/reset=kumquat"}, "not a boolean"),
         ({"foo.ini.jinja": "[/]\n/kumquat=true"}, "unsupported option"),
         ({"foo.ini.jinja": "[/]\nfoo/kumquat=true"}, "unsupported option"),
+        ({"foo.ini.jinja": "foo=1"}, "missing section header"),
+        ({"foo.ini.jinja": "[/]\nfoo"}, "not key=value"),
+        ({"foo.ini.jinja": "[/]\n=1"}, "not key=value"),
     ),
 )
 def test_get_error(
@@ -136,6 +142,49 @@ def test_get_error(
                 },
             ),
         ),
+        (
+            # Test comments and blank lines.
+            {
+                "foo.ini.jinja": textwrap.dedent(
+                    """
+                    # comment
+                    [/]
+                    foo=
+                        # comment
+                        1
+
+                        2
+
+                    bar = 3
+                    """
+                ),
+            },
+            config.Dir(
+                keys={
+                    "foo": config.Key(value=" 1  2"),
+                    "bar": config.Key(value="3"),
+                },
+            ),
+        ),
+        (
+            # Test that only "\n" separates lines.
+            {"foo.ini.jinja": "[/]\nfoo='a\u2028b=c'\nbar='d\x0ce'\n"},
+            config.Dir(
+                keys={
+                    "foo": config.Key(value="'a\u2028b=c'"),
+                    "bar": config.Key(value="'d\x0ce'"),
+                },
+            ),
+        ),
+        (
+            # Test that text after a section header is ignored.
+            {"foo.ini.jinja": "[foo] # comment\nbar=1\n"},
+            config.Dir(
+                subdirs={
+                    "foo": config.Dir(keys={"bar": config.Key(value="1")}),
+                },
+            ),
+        ),
         (
             # Test file merging.
             {
@@ -177,3 +226,87 @@ def test_get(
 ) -> None:
     _write_files(tmp_path, files)
     assert config.get(tmp_path) == expected
+
+
+def test_get_reloads_changed_file(tmp_path: pathlib.Path) -> None:
+    _write_files(tmp_path, {"foo.ini.jinja": "[/]\nfoo=1\n"})
+    assert config.get(tmp_path) == config.Dir(
+        keys={"foo": config.Key(value="1")}
+    )
+    _write_files(tmp_path, {"foo.ini.jinja": "[/]\nfoo=2\n"})
+    os.utime(tmp_path / "foo.ini.jinja", ns=(0, 0))
+    assert config.get(tmp_path) == config.Dir(
+        keys={"foo": config.Key(value="2")}
+    )
+
+
+def test_get_env(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("DCONF_FANCY_LOAD_TEST", "kumquat")
+    _write_files(
+        tmp_path,
+        {
+            "0.ini.jinja": "[/]\nfoo='{{ env['DCONF_FANCY_LOAD_TEST'] }}'\n",
+            "1.ini.jinja": "[/]\nbar='{{ env['DCONF_FANCY_LOAD_TEST'] }}'\n",
+        },
+    )
+    assert config.get(tmp_path) == config.Dir(
+        keys={
+            "foo": config.Key(value="'kumquat'"),
+            "bar": config.Key(value="'kumquat'"),
+        }
+    )
+
+
+def test_get_bytecode_cache(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    cache_dir = tmp_path / "cache"
+    _write_files(config_dir, {"foo.ini.jinja": "[/]\nfoo={{ 1 + 2 }}\n"})
+    expected = config.Dir(keys={"foo": config.Key(value="3")})
+    assert config.get(config_dir, cache_dir=cache_dir) == expected
+    assert list(cache_dir.iterdir())
+
+    # A fresh environment renders from the warm cache without compiling.
+    config._jinja_env.cache_clear()
+    monkeypatch.setattr(
+        jinja2.Environment,
+        "compile",
+        mock.Mock(side_effect=AssertionError("compiled despite cache")),
+    )
+    assert config.get(config_dir, cache_dir=cache_dir) == expected
+
+
+def test_get_bytecode_cache_dir_unusable(tmp_path: pathlib.Path) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    not_a_dir = tmp_path / "not-a-dir"
+    not_a_dir.write_text("")
+    _write_files(config_dir, {"foo.ini.jinja": "[/]\nfoo={{ 1 + 2 }}\n"})
+    assert config.get(config_dir, cache_dir=not_a_dir / "cache") == config.Dir(
+        keys={"foo": config.Key(value="3")}
+    )
+
+
+def test_get_bytecode_cache_io_errors(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    cache_dir = tmp_path / "cache"
+    _write_files(config_dir, {"foo.ini.jinja": "[/]\nfoo={{ 1 + 2 }}\n"})
+    for method in ("load_bytecode", "dump_bytecode"):
+        monkeypatch.setattr(
+            jinja2.FileSystemBytecodeCache,
+            method,
+            mock.Mock(side_effect=PermissionError("read-only")),
+        )
+    assert config.get(config_dir, cache_dir=cache_dir) == config.Dir(
+        keys={"foo": config.Key(value="3")}
+    )
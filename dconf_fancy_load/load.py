@@ -13,46 +13,152 @@
 # limitations under the License.
 """Code to load values into dconf."""
 
-from collections.abc import Collection, Mapping
+from collections.abc import Callable, Collection, Iterator, Mapping, Sequence
+import dataclasses
+import functools
 import subprocess
 import textwrap
 from typing import Any
 
 from dconf_fancy_load import config
 
+# DConf path split on '/', e.g., ('', '') for '/', ('', 'foo', '') for '/foo/',
+# or ('', 'foo', 'bar') for '/foo/bar'. Components are the names from the
+# config, so building child paths doesn't copy any strings.
+_Path = tuple[str, ...]
 
-def _set_keys_in_dir(
-    path: str,
-    values: Mapping[str, str],
+
+def _set_keys(
+    path: _Path,
+    values: Mapping[_Path, Mapping[str, str]],
     *,
     subprocess_run: Any,
     dry_run: bool = False,
 ) -> None:
-    """Sets DConf keys in a directory.
+    """Sets DConf keys with a single `dconf load`.
 
     Args:
-        path: Directory.
-        values: Map from relative key to value to set in the directory.
+        path: Directory to load into.
+        values: Map from directory path under path to map from relative key to
+            value to set in that directory.
         subprocess_run: Normally subprocess.run, but can be overriden in tests.
         dry_run: If true, just print actions.
     """
-    keyfile_lines = ["[/]\n"]
-    # Sort keys to make unit testing easier. (It doesn't matter to dconf load.)
-    for key, value in sorted(values.items(), key=lambda kv: kv[0]):
-        keyfile_lines.append(f"{key}={value}\n")
+    keyfile_lines: list[str] = []
+    # Sort dirs and keys to make unit testing easier. (It doesn't matter to
+    # dconf load.)
+    for dir_path, dir_values in sorted(values.items()):
+        if keyfile_lines:
+            keyfile_lines.append("\n")
+        # Groups are relative to path, like in the output of `dconf dump`.
+        group = "/".join(dir_path[len(path) - 1 : -1]) or "/"
+        keyfile_lines.append(f"[{group}]\n")
+        for key, value in sorted(dir_values.items()):
+            keyfile_lines.append(f"{key}={value}\n")
     keyfile = "".join(keyfile_lines)
+    path_str = "/".join(path)
     if dry_run:
-        print(f"Load: {path}\n{textwrap.indent(keyfile, '  ')}")
+        print(f"Load: {path_str}\n{textwrap.indent(keyfile, '  ')}")
     else:
+        # Keyfiles are always UTF-8, regardless of the locale's encoding, so
+        # encode once here instead of with text=True.
         subprocess_run(
-            ["dconf", "load", path], input=keyfile, text=True, check=True
+            ["dconf", "load", path_str], input=keyfile.encode(), check=True
         )
 
 
+# Trie of paths to not reset. Keys are child names as printed by `dconf list`,
+# e.g., 'foo/' for a dir or 'bar' for a key. A value of None means that the
+# child is preserved entirely.
+_PreserveTrie = dict[str, "_PreserveTrie | None"]
+
+
+def _build_preserve_trie(
+    path: _Path,
+    preserve: Collection[_Path],
+) -> _PreserveTrie:
+    """Returns a trie of paths to not reset.
+
+    Args:
+        path: Directory that contains all of preserve.
+        preserve: Collection of paths to not reset.
+    """
+    trie: _PreserveTrie = {}
+    for preserved in preserve:
+        *dir_names, key_name = preserved[len(path) - 1 :]
+        children = [dir_name + "/" for dir_name in dir_names]
+        if key_name:
+            children.append(key_name)
+        node = trie
+        for child in children[:-1]:
+            child_node = node.setdefault(child, {})
+            if child_node is None:
+                break  # An ancestor is already preserved entirely.
+            node = child_node
+        else:
+            node[children[-1]] = None
+    return trie
+
+
+def _dump_dconf_tree(*, subprocess_run: Any) -> Mapping[str, Sequence[str]]:
+    """Returns all DConf directories, from a single `dconf dump /`.
+
+    Args:
+        subprocess_run: Normally subprocess.run, but can be overriden in tests.
+
+    Returns:
+        Map from directory path, e.g., '/' or '/foo/', to its children as
+        printed by `dconf list`, e.g., 'bar/' for a dir or 'baz' for a key.
+    """
+    dconf_dump = subprocess_run(
+        ["dconf", "dump", "/"], stdout=subprocess.PIPE, text=True, check=True
+    )
+    # Map from directory path to children, with dicts as ordered sets.
+    tree: dict[str, dict[str, None]] = {}
+    dir_path = "/"
+    for line in dconf_dump.stdout.splitlines():
+        if not line:
+            continue
+        if line.startswith("["):
+            group = line[1:-1]
+            dir_path = "/" if group == "/" else f"/{group}/"
+            tree.setdefault(dir_path, {})
+            # `dconf dump` only has groups for dirs with keys, so add each
+            # ancestor of the group too.
+            child_path = dir_path
+            while child_path != "/":
+                parent_path, _, name = child_path[:-1].rpartition("/")
+                parent_path += "/"
+                siblings = tree.setdefault(parent_path, {})
+                if name + "/" in siblings:
+                    break  # The other ancestors were already added.
+                siblings[name + "/"] = None
+                child_path = parent_path
+            continue
+        key, _, _ = line.partition("=")
+        tree.setdefault(dir_path, {})[key] = None
+    return {path: list(children) for path, children in tree.items()}
+
+
+def _reset(path: str, *, subprocess_run: Any, dry_run: bool) -> None:
+    """Resets a key or directory.
+
+    Args:
+        path: Absolute path to reset, e.g., '/', '/foo/', or '/foo/bar'.
+        subprocess_run: Normally subprocess.run, but can be overriden in tests.
+        dry_run: If true, just print actions.
+    """
+    if dry_run:
+        print(f"Reset: {path}")
+    else:
+        subprocess_run(["dconf", "reset", "-f", path], check=True)
+
+
 def _reset_path(
     path: str,
     *,
-    preserve: Collection[str] = (),
+    preserve: _PreserveTrie | None,
+    dconf_tree: Callable[[], Mapping[str, Sequence[str]]],
     subprocess_run: Any,
     dry_run: bool = False,
 ) -> None:
@@ -61,93 +167,220 @@ def _reset_path(
     Args:
         path: Absolute path to selectively reset, e.g., '/', '/foo/', or
             '/foo/bar'.
-        preserve: Collection of absolute child paths to not reset. Dirs end in
-            '/', keys don't. This is ignored if path is a key.
+        preserve: Trie of child paths to not reset, from
+            _build_preserve_trie(). This is ignored if path is a key.
+        dconf_tree: Returns the output of _dump_dconf_tree(). This is only
+            called if something needs to be preserved.
         subprocess_run: Normally subprocess.run, but can be overriden in tests.
         dry_run: If true, just print actions.
     """
-    if not preserve or not path.endswith("/"):
-        if dry_run:
-            print(f"Reset: {path}")
-        else:
-            subprocess_run(["dconf", "reset", "-f", path], check=True)
-        return
-    dconf_list = subprocess_run(
-        ["dconf", "list", path], stdout=subprocess.PIPE, text=True, check=True
-    )
-    for child in dconf_list.stdout.splitlines():
-        child_path = path + child
-        if child_path in preserve:
-            continue
-        _reset_path(
-            child_path,
-            preserve={x for x in preserve if x.startswith(child_path)},
-            subprocess_run=subprocess_run,
-            dry_run=dry_run,
-        )
+    if preserve and path.endswith("/"):
+        children = dconf_tree().get(path, ())
+        # If none of the preserved paths exist yet, there's nothing to preserve,
+        # so reset the whole directory at once instead of each child. (Values
+        # are set after all resets, so they don't need to exist yet.)
+        if not preserve.keys().isdisjoint(children):
+            for child in children:
+                if child in preserve and preserve[child] is None:
+                    continue
+                _reset_path(
+                    path + child,
+                    preserve=preserve.get(child),
+                    dconf_tree=dconf_tree,
+                    subprocess_run=subprocess_run,
+                    dry_run=dry_run,
+                )
+            return
+    _reset(path, subprocess_run=subprocess_run, dry_run=dry_run)
 
 
-def load(
+def _load_keys(
     dir_: config.Dir,
     *,
-    path: str = "/",
-    dry_run: bool = False,
-    subprocess_run: Any = subprocess.run,
-) -> Collection[str]:
-    """Loads DConf values from the config.
+    path: _Path,
+    reset: bool,
+    values: dict[_Path, Mapping[str, str]],
+    dry_run: bool,
+    subprocess_run: Any,
+) -> set[_Path]:
+    """Resets DConf keys in a directory, and collects values to set.
 
     Args:
-        dir_: Configured directory to load.
-        path: DConf path of the directory, e.g., '/' or '/foo/'.
+        dir_: Configured directory to load the keys of.
+        path: DConf path of the directory.
+        reset: Whether the directory or an ancestor will be reset, so resetting
+            individual keys is redundant.
+        values: Map from directory path to map from key to value to set in that
+            directory. This function adds the values to set in dir_.
         dry_run: If true, just print actions.
         subprocess_run: Normally subprocess.run, but can be overriden in tests.
 
     Returns:
-        Collection of paths to not reset, suitable for passing as the preserve
-        argument to _reset_path.
+        Set of key paths to not reset.
     """
     preserve = set()
-    values = {}  # Map from key to value to set in the current directory.
+    dir_values = {}  # Map from key to value to set in the current directory.
     for key_name, key in dir_.keys.items():
-        key_path = path + key_name
+        key_path = path[:-1] + (key_name,)
         if key.value is not None:
-            values[key_name] = key.value
+            dir_values[key_name] = key.value
             preserve.add(key_path)
         if key.reset is not None:
             if key.reset:
-                _reset_path(
-                    key_path,
-                    subprocess_run=subprocess_run,
-                    dry_run=dry_run,
-                )
+                if not reset:
+                    _reset(
+                        "/".join(key_path),
+                        subprocess_run=subprocess_run,
+                        dry_run=dry_run,
+                    )
             else:
                 preserve.add(key_path)
-    for subdir_name, subdir in dir_.subdirs.items():
-        subdir_path = path + subdir_name + "/"
-        subdir_preserve = load(
-            subdir,
-            path=subdir_path,
-            dry_run=dry_run,
-            subprocess_run=subprocess_run,
+    if dir_values:
+        values[path] = dir_values
+    return preserve
+
+
+@dataclasses.dataclass(kw_only=True)
+class _DirLoad:
+    """State of a directory being loaded by _load_dir().
+
+    Attributes:
+        dir_: Configured directory.
+        path: DConf path of the directory.
+        reset: Whether the directory or an ancestor will be reset.
+        subdirs: Iterator over subdirs that haven't been loaded yet.
+        preserve: Paths in the directory to not reset.
+    """
+
+    dir_: config.Dir
+    path: _Path
+    reset: bool
+    subdirs: Iterator[tuple[str, config.Dir]]
+    preserve: set[_Path]
+
+
+def _load_dir(
+    dir_: config.Dir,
+    *,
+    path: _Path,
+    values: dict[_Path, Mapping[str, str]],
+    dry_run: bool,
+    subprocess_run: Any,
+) -> Collection[_Path]:
+    """Resets DConf values from the config, and collects values to set.
+
+    Resets that would be redundant with the reset of an ancestor are skipped.
+
+    Args:
+        dir_: Configured directory to load.
+        path: DConf path of the directory.
+        values: Map from directory path to map from key to value to set in that
+            directory. This function adds the values to set in dir_ and its
+            descendants.
+        dry_run: If true, just print actions.
+        subprocess_run: Normally subprocess.run, but can be overriden in tests.
+
+    Returns:
+        Collection of paths to not reset, suitable for passing to
+        _build_preserve_trie().
+    """
+
+    def start(dir_: config.Dir, *, path: _Path, reset: bool) -> _DirLoad:
+        return _DirLoad(
+            dir_=dir_,
+            path=path,
+            reset=reset,
+            subdirs=iter(dir_.subdirs.items()),
+            preserve=_load_keys(
+                dir_,
+                path=path,
+                reset=reset,
+                values=values,
+                dry_run=dry_run,
+                subprocess_run=subprocess_run,
+            ),
         )
-        if subdir.reset is not None:
-            if subdir.reset:
-                _reset_path(
-                    subdir_path,
-                    subprocess_run=subprocess_run,
-                    preserve=subdir_preserve,
-                    dry_run=dry_run,
+
+    @functools.cache
+    def dconf_tree() -> Mapping[str, Sequence[str]]:
+        return _dump_dconf_tree(subprocess_run=subprocess_run)
+
+    # Stack for a post-order traversal of the dirs, from dir_ to the current
+    # dir. dir_ itself is never reset here, only its descendants.
+    stack = [start(dir_, path=path, reset=False)]
+    while True:
+        current = stack[-1]
+        next_subdir = next(current.subdirs, None)
+        if next_subdir is not None:
+            subdir_name, subdir = next_subdir
+            stack.append(
+                start(
+                    subdir,
+                    path=current.path[:-1] + (subdir_name, ""),
+                    reset=(
+                        current.reset if subdir.reset is None else subdir.reset
+                    ),
                 )
-            # Preserve the directory either way. Either it was already reset, so
-            # preserving it is an optimization, or the entire directory needs to
-            # be preserved.
-            preserve.add(subdir_path)
-        else:
-            # No explicit reset parameter, so preserve the preserved paths
-            # from the children.
-            preserve.update(subdir_preserve)
+            )
+            continue
+        stack.pop()
+        if not stack:
+            return current.preserve
+        parent = stack[-1]
+        if current.dir_.reset is None or (current.dir_.reset and parent.reset):
+            # No explicit reset parameter, or the parent's reset will cover this
+            # directory too, so preserve the preserved paths from the children.
+            parent.preserve.update(current.preserve)
+            continue
+        if current.dir_.reset:
+            _reset_path(
+                "/".join(current.path),
+                subprocess_run=subprocess_run,
+                preserve=_build_preserve_trie(current.path, current.preserve),
+                dconf_tree=dconf_tree,
+                dry_run=dry_run,
+            )
+        # Preserve the directory either way. Either it was already reset, so
+        # preserving it is an optimization, or the entire directory needs to be
+        # preserved.
+        parent.preserve.add(current.path)
+
+
+def load(
+    dir_: config.Dir,
+    *,
+    path: str = "/",
+    dry_run: bool = False,
+    subprocess_run: Any = subprocess.run,
+) -> Collection[str]:
+    """Loads DConf values from the config.
+
+    All resets happen first, then all values are set with a single
+    `dconf load`.
+
+    Args:
+        dir_: Configured directory to load.
+        path: DConf path of the directory, e.g., '/' or '/foo/'.
+        dry_run: If true, just print actions.
+        subprocess_run: Normally subprocess.run, but can be overriden in tests.
+
+    Returns:
+        Collection of paths to not reset. Dirs end in '/', keys don't.
+    """
+    path_components = tuple(path.split("/"))
+    values: dict[_Path, Mapping[str, str]] = {}
+    preserve = _load_dir(
+        dir_,
+        path=path_components,
+        values=values,
+        dry_run=dry_run,
+        subprocess_run=subprocess_run,
+    )
     if values:
-        _set_keys_in_dir(
-            path, values, subprocess_run=subprocess_run, dry_run=dry_run
+        _set_keys(
+            path_components,
+            values,
+            subprocess_run=subprocess_run,
+            dry_run=dry_run,
         )
-    return preserve
+    return {"/".join(preserved) for preserved in preserve}
@@ -22,12 +22,30 @@ from unittest import mock
 from dconf_fancy_load import config
 from dconf_fancy_load import load
 
+# Creating an autospec inspects subprocess.run, so do it once and reset it in
+# each test.
+_RUN = mock.create_autospec(subprocess.run, spec_set=True)
+
+# Keyfile that test_set expects to be loaded.
+_TEST_SET_KEYFILE = textwrap.dedent(
+    """\
+    [/]
+    foo='bar'
+
+    [some-dir/other-dir]
+    apple='orange'
+    kumquat=17
+    """
+).encode()
+
 
 class LoadTest(unittest.TestCase):
 
     def setUp(self) -> None:
         super().setUp()
-        self._run = mock.create_autospec(subprocess.run, spec_set=True)
+        # The function autospec's own reset_mock() can't reset side_effect.
+        _RUN.mock.reset_mock(return_value=True, side_effect=True)
+        self._run = _RUN
 
     def _load(self, *args: Any, **kwargs: Any) -> Collection[str]:
         """Calls load with appropriate mocks.
@@ -41,13 +59,21 @@ class LoadTest(unittest.TestCase):
         """
         return load.load(*args, **kwargs, subprocess_run=self._run)
 
-    def _mock_dconf_list(self, paths: Mapping[str, Sequence[str]]) -> None:
-        """Mocks `dconf list`.
+    def _mock_dconf_dump(self, paths: Mapping[str, Sequence[str]]) -> None:
+        """Mocks `dconf dump /`.
 
         Args:
-            paths: Map from path passed to `donf list` to list of paths printed
-                by `dconf list`.
+            paths: Map from dir path to list of paths that `dconf list` would
+                print for it. The dump has a group with each dir's keys.
         """
+        groups = []
+        for path, items in paths.items():
+            keys = [item for item in items if not item.endswith("/")]
+            if keys:
+                groups.append(
+                    f"[{path.strip('/') or '/'}]\n"
+                    + "".join(f"{key}=0\n" for key in keys)
+                )
 
         def side_effect(
             args: Any,
@@ -56,10 +82,9 @@ class LoadTest(unittest.TestCase):
             completed_process = mock.create_autospec(
                 subprocess.CompletedProcess, instance=True
             )
-            if args[:2] != ["dconf", "list"]:
+            if args != ["dconf", "dump", "/"]:
                 return completed_process
-            items = paths[args[2]]
-            completed_process.stdout = "".join((item + "\n" for item in items))
+            completed_process.stdout = "\n".join(groups)
             return completed_process
 
         self._run.side_effect = side_effect
@@ -90,42 +115,19 @@ class LoadTest(unittest.TestCase):
             },
             set(preserved),
         )
-        expected_calls = []
-        for path, keyfile in (
-            (
-                "/",
-                textwrap.dedent(
-                    """\
-                        [/]
-                        foo='bar'
-                    """
-                ),
-            ),
-            (
-                "/some-dir/other-dir/",
-                textwrap.dedent(
-                    """\
-                        [/]
-                        apple='orange'
-                        kumquat=17
-                    """
-                ),
-            ),
-        ):
-            expected_calls.append(
+        self.assertSequenceEqual(
+            [
                 mock.call(
-                    ["dconf", "load", path],
-                    input=keyfile,
-                    text=True,
+                    ["dconf", "load", "/"],
+                    input=_TEST_SET_KEYFILE,
                     check=True,
                 )
-            )
-        self.assertSequenceEqual(
-            sorted(expected_calls), sorted(self._run.mock_calls)
+            ],
+            self._run.mock_calls,
         )
 
     def test_reset(self) -> None:
-        self._mock_dconf_list(
+        self._mock_dconf_dump(
             {
                 "/": ["foo", "bar", "some-dir/"],
                 "/some-dir/": ["other-dir/", "apple", "kumquat"],
@@ -163,12 +165,156 @@ class LoadTest(unittest.TestCase):
         actual_reset_calls = [
             call for call in self._run.mock_calls if call[1][0][1] == "reset"
         ]
+        self.assertCountEqual(expected_reset_calls, actual_reset_calls)
+
+    def test_reset_dumps_once(self) -> None:
+        self._mock_dconf_dump(
+            {
+                "/": ["some-dir/", "other-dir/"],
+                "/some-dir/": ["apple", "kumquat"],
+                "/other-dir/": ["apple", "kumquat"],
+            }
+        )
+        self._load(
+            config.Dir(
+                subdirs={
+                    "some-dir": config.Dir(
+                        reset=True,
+                        keys={"apple": config.Key(reset=False)},
+                    ),
+                    "other-dir": config.Dir(
+                        reset=True,
+                        keys={"apple": config.Key(reset=False)},
+                    ),
+                },
+            )
+        )
+        self.assertCountEqual(
+            [
+                mock.call(
+                    ["dconf", "dump", "/"],
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    check=True,
+                ),
+                mock.call(
+                    ["dconf", "reset", "-f", "/some-dir/kumquat"], check=True
+                ),
+                mock.call(
+                    ["dconf", "reset", "-f", "/other-dir/kumquat"], check=True
+                ),
+            ],
+            self._run.mock_calls,
+        )
+
+    def test_reset_whole_dir_when_preserved_paths_are_missing(self) -> None:
+        self._mock_dconf_dump({"/some-dir/": ["apple", "kumquat"]})
+        self._load(
+            config.Dir(
+                subdirs={
+                    "some-dir": config.Dir(
+                        reset=True,
+                        keys={"foo": config.Key(value="1")},
+                    ),
+                },
+            )
+        )
+        self.assertSequenceEqual(
+            [
+                mock.call(
+                    ["dconf", "dump", "/"],
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    check=True,
+                ),
+                mock.call(["dconf", "reset", "-f", "/some-dir/"], check=True),
+                mock.call(
+                    ["dconf", "load", "/"],
+                    input=b"[some-dir]\nfoo=1\n",
+                    check=True,
+                ),
+            ],
+            self._run.mock_calls,
+        )
+
+    def test_reset_skips_redundant_resets(self) -> None:
+        preserved = self._load(
+            config.Dir(
+                subdirs={
+                    "some-dir": config.Dir(
+                        reset=True,
+                        subdirs={
+                            "other-dir": config.Dir(
+                                reset=True,
+                                keys={"kumquat": config.Key(reset=True)},
+                            ),
+                        },
+                        keys={"apple": config.Key(reset=True)},
+                    ),
+                },
+            )
+        )
+        self.assertEqual({"/some-dir/"}, preserved)
         self.assertSequenceEqual(
-            sorted(expected_reset_calls), sorted(actual_reset_calls)
+            [mock.call(["dconf", "reset", "-f", "/some-dir/"], check=True)],
+            self._run.mock_calls,
+        )
+
+    def test_deep(self) -> None:
+        root = config.Dir()
+        root.get_subdir(("d",) * 2000).keys["foo"] = config.Key(value="1")
+        preserved = self._load(root)
+        self.assertEqual({"/d" * 2000 + "/foo"}, preserved)
+        self.assertSequenceEqual(
+            [
+                mock.call(
+                    ["dconf", "load", "/"],
+                    input=f"[{'/'.join(('d',) * 2000)}]\nfoo=1\n".encode(),
+                    check=True,
+                )
+            ],
+            self._run.mock_calls,
+        )
+
+    def test_build_preserve_trie(self) -> None:
+        self.assertEqual(
+            {"some-dir/": {"other-dir/": None, "apple": None}, "foo": None},
+            load._build_preserve_trie(
+                ("", ""),
+                (
+                    ("", "some-dir", "other-dir", ""),
+                    ("", "some-dir", "other-dir", "kumquat"),
+                    ("", "some-dir", "apple"),
+                    ("", "foo"),
+                ),
+            ),
+        )
+
+    def test_reset_before_set(self) -> None:
+        self._load(
+            config.Dir(
+                subdirs={
+                    "some-dir": config.Dir(
+                        keys={"bar": config.Key(value="1")},
+                    ),
+                },
+                keys={"foo": config.Key(reset=True)},
+            )
+        )
+        self.assertSequenceEqual(
+            [
+                mock.call(["dconf", "reset", "-f", "/foo"], check=True),
+                mock.call(
+                    ["dconf", "load", "/"],
+                    input=b"[some-dir]\nbar=1\n",
+                    check=True,
+                ),
+            ],
+            self._run.mock_calls,
         )
 
     def test_dry_run_does_not_write_to_dconf(self) -> None:
-        self._mock_dconf_list(
+        self._mock_dconf_dump(
             {
                 "/": ["foo", "bar", "some-dir/"],
                 "/some-dir/": ["foo"],
@@ -189,7 +335,7 @@ class LoadTest(unittest.TestCase):
             dry_run=True,
         )
         actual_write_calls = [
-            call for call in self._run.mock_calls if call[1][0][1] != "list"
+            call for call in self._run.mock_calls if call[1][0][1] != "dump"
         ]
         self.assertSequenceEqual((), actual_write_calls)
 
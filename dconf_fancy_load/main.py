@@ -15,6 +15,7 @@
 
 import argparse
 from collections.abc import Sequence
+import os
 import pathlib
 import subprocess
 import sys
@@ -41,9 +42,17 @@ def main(
         default=pathlib.Path.home().joinpath(".config", "dconf-fancy-load"),
         type=pathlib.Path,
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=pathlib.Path(
+            os.environ.get("XDG_CACHE_HOME")
+            or pathlib.Path.home().joinpath(".cache")
+        ).joinpath("dconf-fancy-load", "jinja"),
+        type=pathlib.Path,
+    )
     parser.add_argument("--dry-run", action="store_true")
     parsed_args = parser.parse_args(args)
-    root = config.get(parsed_args.config_dir)
+    root = config.get(parsed_args.config_dir, cache_dir=parsed_args.cache_dir)
     load.load(root, dry_run=parsed_args.dry_run, subprocess_run=subprocess_run)
 
 